@@ -5,94 +5,250 @@ Systemd service for managing wireguard interfaces and database.
 '''
 
 import os
-import re
+import shutil
+import time
+import threading
+import contextlib
 import subprocess
-import shlex
 import logging
+import functools
+import itertools
+import weakref
 import ipaddress
+from dataclasses import dataclass
 import psycopg2
+from psycopg2.extras import execute_batch
 
 logger = logging.getLogger(__name__)
 
+PREPARED = {
+    'wg_interface_states':
+        'SELECT name, state FROM wgconsole_interface',
+    'wg_peer_states':
+        'SELECT public_key, state FROM wgconsole_peer',
+    'wg_interface_settings':
+        'SELECT name, address, port, public_key FROM wgconsole_interface '
+        'ORDER BY name',
+    'wg_interface_peers':
+        'SELECT i.name, i.status, i.state, '
+        'p.public_key, p.allowed_ips, p.status '
+        'FROM wgconsole_interface i '
+        'LEFT JOIN wgconsole_peer p ON p.interface_id = i.name '
+        'ORDER BY i.name',
+    'wg_interface_state':
+        'UPDATE wgconsole_interface SET state = $1 WHERE name = $2',
+    'wg_interface_setup':
+        'UPDATE wgconsole_interface SET address = COALESCE($1, address), '
+        'port = COALESCE($2, port), '
+        'public_key = COALESCE($3, public_key) WHERE name = $4',
+    'wg_peer_state':
+        'UPDATE wgconsole_peer SET state = $1 WHERE public_key = $2',
+    'wg_peer_clear':
+        'UPDATE wgconsole_peer SET state = \'\' WHERE public_key = $1',
+}
+_prepared = weakref.WeakSet()
+
+def db_prepare(
+    conn # psycopg2 database connection object
+) -> None:
+    '''
+    Prepare PREPARED statements once per database connection.
+    '''
+    if conn in _prepared:
+        return
+    with conn.cursor() as curp:
+        curp.execute('DEALLOCATE ALL;')
+        for name, statement in PREPARED.items():
+            curp.execute(f'PREPARE {name} AS {statement};')
+    _prepared.add(conn)
+
+NOTIFY_CHANNEL = 'wg_changed'
+NOTIFY_TRIGGERS = f'''
+CREATE OR REPLACE FUNCTION wgconsole_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{NOTIFY_CHANNEL}', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS wgconsole_interface_notify ON wgconsole_interface;
+CREATE TRIGGER wgconsole_interface_notify
+AFTER INSERT OR DELETE OR UPDATE OF name, status ON wgconsole_interface
+FOR EACH STATEMENT EXECUTE FUNCTION wgconsole_notify();
+DROP TRIGGER IF EXISTS wgconsole_peer_notify ON wgconsole_peer;
+CREATE TRIGGER wgconsole_peer_notify
+AFTER INSERT OR DELETE
+OR UPDATE OF public_key, allowed_ips, status, interface_id ON wgconsole_peer
+FOR EACH STATEMENT EXECUTE FUNCTION wgconsole_notify();
+'''
+NOTIFY_CHECK = '''
+SELECT count(*) FROM pg_trigger
+WHERE tgname IN ('wgconsole_interface_notify', 'wgconsole_peer_notify')
+'''
+
+def db_listen(
+    conn # psycopg2 database connection object in autocommit mode
+) -> None:
+    '''
+    Install missing change notification triggers and listen to their
+    channel. Triggers fire only on columns managed by web interface, so
+    state updates made by the service do not wake it up. Without them
+    service falls back to waiting for the next cycle.
+    '''
+    with conn.cursor() as curl:
+        try:
+            curl.execute(NOTIFY_CHECK)
+            # DROP TRIGGER locks the tables, skip it when installed
+            if curl.fetchone()[0] < 2:
+                curl.execute(NOTIFY_TRIGGERS)
+        except psycopg2.DatabaseError as exception:
+            logger.error(
+                'Error installing notification triggers'
+                '\n%s\n\n', exception
+            )
+        curl.execute(f'LISTEN {NOTIFY_CHANNEL};')
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def db_transaction(
+    pool # psycopg2 connection pool object
+):
+    '''
+    Run all db_read and db_write calls of current thread in one
+    transaction, commit on success and roll back on exception.
+    '''
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+    conn = pool.getconn()
+    try:
+        with conn:
+            _local.conn = conn
+            yield conn
+    finally:
+        _local.conn = None
+        pool.putconn(conn, close=bool(conn.closed))
+
+@contextlib.contextmanager
+def db_cursor(
+    pool # psycopg2 connection pool object
+):
+    '''
+    Cursor for single statement. Statement runs in its own transaction,
+    inside db_transaction failed statement is rolled back alone.
+    '''
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        with db_transaction(pool) as conn:
+            with conn.cursor() as curs:
+                db_prepare(conn)
+                yield curs
+        return
+    with conn.cursor() as curs:
+        curs.execute('SAVEPOINT wgconsole_statement;')
+        try:
+            db_prepare(conn)
+            yield curs
+        except psycopg2.ProgrammingError:
+            curs.execute('ROLLBACK TO SAVEPOINT wgconsole_statement;')
+            raise
+        curs.execute('RELEASE SAVEPOINT wgconsole_statement;')
+
 def db_read(
-    connection, # psycopg2 database connection object
+    pool, # psycopg2 connection pool object
     command:str
 ) -> tuple:
     '''
     Read records from PostgreSQL database table.
     '''
-    with connection as conn:
-        with conn.cursor() as curr:
-            try:
-                curr.execute(command)
-                records = tuple(curr)
-                logger.debug(
-                    'Reading records from database'
-                    '\nCommand:\n%s\n'
-                    'Result:\n%s\n\n',
-                    command, records
-                )
-                return records
-            except psycopg2.ProgrammingError as exception:
-                logger.error(
-                    'Error reading from database'
-                    '\nCommand:\n%s\n%s\n\n',
-                    command, exception
-                )
-                return tuple()
+    try:
+        with db_cursor(pool) as curr:
+            curr.execute(command)
+            records = tuple(curr)
+    except psycopg2.ProgrammingError as exception:
+        logger.error(
+            'Error reading from database'
+            '\nCommand:\n%s\n%s\n\n',
+            command, exception
+        )
+        return tuple()
+    logger.debug(
+        'Reading records from database'
+        '\nCommand:\n%s\n'
+        'Result:\n%s\n\n',
+        command, records
+    )
+    return records
 
 def db_write(
-    connection, # psycopg2 database connection object
-    command:str
-) -> None:
+    pool, # psycopg2 connection pool object
+    command:str,
+    records:list
+) -> bool:
     '''
-    Write records to PostgreSQL database table.
+    Write records to PostgreSQL database table, returns False if
+    writing failed.
     '''
-    with connection as conn:
-        with conn.cursor() as curw:
-            try:
-                curw.execute(command)
-                logger.debug(
-                    'Writing records to database'
-                    '\nCommand:\n%s\n\n', command
-                )
-            except psycopg2.ProgrammingError as exception:
-                logger.error(
-                    'Error writing to database'
-                    '\nCommand:\n%s\n%s\n\n',
-                    command, exception
-                )
+    if not records:
+        return True
+    try:
+        with db_cursor(pool) as curw:
+            execute_batch(curw, command, records, page_size=100)
+    except psycopg2.ProgrammingError as exception:
+        logger.error(
+            'Error writing to database'
+            '\nCommand:\n%s\n%s\n\n',
+            command, exception
+        )
+        return False
+    logger.debug(
+        'Writing records to database'
+        '\nCommand:\n%s\n'
+        'Records:\n%s\n\n',
+        command, records
+    )
+    return True
+
+@functools.lru_cache(maxsize=None)
+def which(program:str) -> str:
+    '''
+    Resolve executable path once instead of searching PATH on every exec.
+    '''
+    return shutil.which(program) or program
 
 def run_cmmd(
-    command: str,
+    argv: list,
     input_str: str = None,
-    logerr: bool = False
+    logerr: bool = False,
+    logstdout: bool = True
 ) -> str:
     '''
-    Subprocess module wrapper
+    Subprocess module wrapper, returns False if process failed.
+    Set logstdout to False for output containing secret keys.
     '''
     try:
         process = subprocess.run(
-            shlex.split(command),
+            [which(argv[0]), *argv[1:]],
             input = input_str,
             capture_output=True,
             encoding='UTF-8',
             timeout=5,
             check=True
         )
-        logger.debug(
-            'Process complited'
-            '\nCommand:\n%s\nstdout:\n%s\n\n',
-            command, process.stdout
-        )
-        if process.stdout:
-            return process.stdout
-        return False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                'Process complited'
+                '\nCommand:\n%s\nstdout:\n%s\n\n',
+                ' '.join(argv),
+                process.stdout if logstdout else '(not logged)'
+            )
+        return process.stdout
     except FileNotFoundError as exception:
         logger.debug(
             'Process failed, executable could not be found'
             '\nCommand:\n%s\n%s\n\n',
-            command, exception
+            ' '.join(argv), exception
         )
         return False
     except subprocess.CalledProcessError as exception:
@@ -101,17 +257,137 @@ def run_cmmd(
                 'Process failed because did not return a successful '
                 'return code'
                 '\nCommand:\n%s\nReturned: %s\n%s\n\n',
-                command, exception.returncode, exception.stderr
+                ' '.join(argv), exception.returncode, exception.stderr
             )
         return False
     except subprocess.TimeoutExpired as exception:
         logger.error(
             'Process timed out'
             '\nCommand:\n%s\n%s\n\n',
-            command, exception
+            ' '.join(argv), exception
         )
         return False
 
+class PubkeyError(Exception):
+    '''
+    wg pubkey failed, raised to keep failure out of cache.
+    '''
+
+@functools.lru_cache(maxsize=256)
+def _derive_pubkey(private_key:str) -> str:
+    pubkey = run_cmmd(
+        ['wg', 'pubkey'],
+        input_str = f'{private_key}',
+        logerr = True
+    )
+    if pubkey is False:
+        raise PubkeyError
+    return pubkey.rstrip('\n')
+
+def derive_pubkey(private_key:str) -> str:
+    '''
+    Derive public key from private key, successful result is cached
+    per key, failed one (e.g. timeout) is retried on next call.
+    '''
+    try:
+        return _derive_pubkey(private_key)
+    except PubkeyError:
+        return False
+
+def pretty_time(seconds:int) -> str:
+    '''
+    Format time interval the same way as wg show.
+    '''
+    if not seconds:
+        return 'Now'
+    parts = []
+    for unit, size in (
+        ('year', 365*24*60*60),
+        ('day', 24*60*60),
+        ('hour', 60*60),
+        ('minute', 60),
+        ('second', 1),
+    ):
+        value, seconds = divmod(seconds, size)
+        if value:
+            parts.append(f'{value} {unit}{"s" if value != 1 else ""}')
+    return ', '.join(parts)
+
+def pretty_bytes(count:int) -> str:
+    '''
+    Format bytes count the same way as wg show.
+    '''
+    if count < 1024:
+        return f'{count} B'
+    for unit in ('KiB', 'MiB', 'GiB'):
+        count /= 1024
+        if count < 1024:
+            return f'{count:.2f} {unit}'
+    return f'{count / 1024:.2f} TiB'
+
+@dataclass(slots=True)
+class PeerState:
+    '''
+    Peer properties as shown by wg show.
+    '''
+    preshared_key: str = ''
+    endpoint: str = ''
+    allowed_ips: str = ''
+    latest_handshake: str = ''
+    transfer: str = ''
+    persistent_keepalive: str = ''
+
+    def __str__(self) -> str:
+        return '\n'.join(
+            f'{prop}: {value}' for prop, value in (
+                ('preshared key', self.preshared_key),
+                ('endpoint', self.endpoint),
+                ('allowed ips', self.allowed_ips),
+                ('latest handshake', self.latest_handshake),
+                ('transfer', self.transfer),
+                ('persistent keepalive', self.persistent_keepalive),
+            ) if value
+        )
+
+def parse_peer(
+    preshared_key:str,
+    endpoint:str,
+    allowed_ips:str,
+    latest_handshake:str,
+    transfer_rx:str,
+    transfer_tx:str,
+    persistent_keepalive:str
+) -> PeerState:
+    '''
+    Convert peer fields of wg show all dump to PeerState.
+    '''
+    peer = PeerState(allowed_ips = allowed_ips.replace(',', ', '))
+    if preshared_key != '(none)':
+        peer.preshared_key = '(hidden)'
+    if endpoint != '(none)':
+        peer.endpoint = endpoint
+    if latest_handshake != '0':
+        seconds = int(time.time()) - int(latest_handshake)
+        if seconds < 0:
+            # Same note as wg show prints
+            peer.latest_handshake = (
+                '(System clock wound backward; '
+                'connection problems may ensue.)'
+            )
+        else:
+            ago = pretty_time(seconds)
+            peer.latest_handshake = ago if ago == 'Now' else f'{ago} ago'
+    if transfer_rx != '0' or transfer_tx != '0':
+        peer.transfer = (
+            f'{pretty_bytes(int(transfer_rx))} received, '
+            f'{pretty_bytes(int(transfer_tx))} sent'
+        )
+    if persistent_keepalive != 'off':
+        peer.persistent_keepalive = (
+            f'every {pretty_time(int(persistent_keepalive))}'
+        )
+    return peer
+
 class WgState:
     '''
     Class for retrieve actual interface state and update it in db. 
@@ -119,8 +395,8 @@ class WgState:
 
     wgstate = {}
 
-    def __init__(self, conn) -> None:
-        self.conn = conn
+    def __init__(self, pool) -> None:
+        self.pool = pool
 
     def update_interface(self) -> None:
         '''
@@ -128,51 +404,39 @@ class WgState:
         '''
         logger.debug('Execute WgState.update_interface\n%s\n\n', '*'*80)
         self.wgstate = {}
+        updates = []
         records = db_read(
-            self.conn,
-            'SELECT name, state\n'
-            'FROM wgconsole_interface;'
+            self.pool,
+            'EXECUTE wg_interface_states;'
         )
+        # Dump contains private and preshared keys in plain text
+        wgdump = run_cmmd(
+            ['wg', 'show', 'all', 'dump'],
+            logstdout = False
+        )
+        interfaces = {}
+        for line in (wgdump or '').splitlines():
+            fields = line.split('\t')
+            if len(fields) == 5:
+                interfaces[fields[0]] = {}
+            elif len(fields) == 9:
+                interfaces[fields[0]][fields[1]] = parse_peer(*fields[2:])
         for record in records:
             name, state = record
-            wgshow = run_cmmd(
-                f'wg show {name}'
-            )
-            if wgshow:
-                showed_state = True
-                peers = {}
-                wgshow_peers = re.findall(
-                    r'(?:peer: )(.+)',
-                    wgshow
-                )
-                for peer in wgshow_peers:
-                    prop_in_wgshow = re.search(
-                        fr'(?s)(?:{re.escape(peer)}\s+)'
-                        r'(?P<props>.+?)(?:peer|\Z)',
-                        wgshow
-                    )
-                    peer_prop = {
-                        f'{prop}':f'{val}' for prop, val
-                        in re.findall(
-                        r'(?:\s*)(\w.+): (.+)(?:\n)',
-                        prop_in_wgshow['props'],
-                    )}
-                    peers.update({peer: peer_prop})
-            if not wgshow:
-                showed_state = False
-                peers = {}
+            showed_state = name in interfaces
+            peers = interfaces.get(name, {})
             if showed_state != state:
-                db_write(
-                    self.conn,
-                    'UPDATE wgconsole_interface\n'
-                    f'SET state = \'{showed_state}\'\n'
-                    f'WHERE name = \'{name}\';'
-                )
+                updates.append((showed_state, name))
             self.wgstate.update({name: {
                 'state':showed_state,
                 'peers':peers,
                 }}
             )
+        db_write(
+            self.pool,
+            'EXECUTE wg_interface_state (%s, %s);',
+            updates
+        )
         logger.debug(
             'End of WgState.update_interface executing, '
             'wgstate variable contains:\n%s\n\n',
@@ -185,36 +449,35 @@ class WgState:
         '''
         logger.debug('Execute WgState.update_peer\n%s\n\n', '*'*80)
         records = db_read(
-            self.conn,
-            'SELECT public_key, state\n'
-            'FROM wgconsole_peer;'
+            self.pool,
+            'EXECUTE wg_peer_states;'
         )
         db_peers = dict(records)
         all_active_peers = set({})
+        updates = []
         for interface in self.wgstate.values():
             peers = interface['peers']
             active_peers = {peer for peer in peers if peer in db_peers}
             all_active_peers.update(active_peers)
             for peer in active_peers:
-                peer_state = '\n'.join([
-                    prop + ': ' + peers[peer][prop] for prop
-                    in peers[peer]
-                    ])
+                peer_state = str(peers[peer])
                 if peer_state != db_peers[peer]:
-                    db_write(
-                        self.conn,
-                        'UPDATE wgconsole_peer\n'
-                        f'SET state = \'{peer_state}\'\n'
-                        f'WHERE public_key = \'{peer}\';'
-                    )
-        for peer in db_peers:
-            if peer not in all_active_peers and db_peers[peer] != '':
-                db_write(
-                    self.conn,
-                    'UPDATE wgconsole_peer\n'
-                    f'SET state = \'\'\n'
-                    f'WHERE public_key = \'{peer}\';'
-                )
+                    updates.append((peer_state, peer))
+        clears = [
+            (peer,) for peer in db_peers
+            if peer not in all_active_peers and db_peers[peer] != ''
+        ]
+        with db_transaction(self.pool):
+            db_write(
+                self.pool,
+                'EXECUTE wg_peer_state (%s, %s);',
+                updates
+            )
+            db_write(
+                self.pool,
+                'EXECUTE wg_peer_clear (%s);',
+                clears
+            )
         logger.debug('End of executing WgState.update_peer\n\n')
 
     def update(self) -> None:
@@ -230,56 +493,72 @@ class WgSetup:
     '''
 
     def __init__(self, state:WgState, conf:str) -> None:
-        self.wgstate = state.wgstate
+        # WgState replaces wgstate on update, read it through state
+        self.state = state
         self.conf = os.fspath(conf)
-        self.conn = state.conn
+        self.pool = state.pool
+        self._conf_cache = {} # path: ((st_mtime_ns, st_size), parsed conf)
+        self._conf_hash = {} # interface name: hash of last checked settings
 
-    def conf_setup(self) -> None:
+    def conf_setup(self, interfaces:set = None) -> None:
         '''
-        Update interface settings in db according to .conf file
+        Update interface settings in db according to .conf file.
+        Checks given interface names or interfaces down in wgstate.
         '''
         logger.debug('Execute WgSetup.conf_setup\n%s\n\n', '*'*80)
+        if interfaces is None:
+            interfaces = {
+                name for name, interface in self.state.wgstate.items()
+                if interface['state'] is False
+            }
         records = db_read(
-            self.conn,
-            'SELECT name, address, port, public_key\n'
-            'FROM wgconsole_interface;'
-        )
-        records = (record for record in records
-            if self.wgstate[record[0]]['state'] is False
+            self.pool,
+            'EXECUTE wg_interface_settings;'
         )
+        records = (record for record in records if record[0] in interfaces)
+        settings = []
+        conf_hashes = {}
         for record in records:
             name, address, port, public_key = record
+            path = f'{self.conf}/{name}.conf'
             try:
-                with open(
-                    f'{self.conf}/{name}.conf',
-                    mode='r', buffering=1,
-                    encoding='utf-8',
-                    errors='strict',
-                    newline=None,
-                    closefd=True,
-                    opener=None
-                ) as file:
-                    conf = dict(
-                        line.removesuffix('\n').split(' = ')
-                        for line in file.readlines()
-                        if ' = ' in line
-                    )
+                stat = os.stat(path)
+                key = (stat.st_mtime_ns, stat.st_size)
+                cached = self._conf_cache.get(path)
+                if cached is not None and cached[0] == key:
+                    conf = cached[1]
+                else:
+                    with open(path, encoding='utf-8') as file:
+                        conf = dict(
+                            line.split(' = ', 1)
+                            for line in file.read().splitlines()
+                            if ' = ' in line
+                        )
+                    self._conf_cache[path] = (key, conf)
             except FileNotFoundError:
+                self._conf_cache.pop(path, None)
                 logger.error(
                         'No .conf file: %s',
-                        f'{self.conf}/{name}.conf\n'
+                        f'{path}\n'
                     )
                 continue
+            pubkey = (
+                derive_pubkey(conf['PrivateKey'])
+                if 'PrivateKey' in conf else None
+            )
+            # Skip checks if neither db record nor .conf file has changed
+            conf_hash = hash((
+                record, conf.get('Address'), conf.get('ListenPort'), pubkey
+            ))
+            if self._conf_hash.get(name) == conf_hash:
+                continue
+            conf_hashes[name] = conf_hash
+            setting = [None, None, None] # new address, port, public key
             if 'Address' in conf:
                 try:
                     conf_address = str(ipaddress.ip_network(conf['Address']))
                     if conf_address != address:
-                        db_write(
-                        self.conn,
-                        'UPDATE wgconsole_interface\n'
-                        f'SET address = \'{conf["Address"]}\'\n'
-                        f'WHERE name = \'{name}\';'
-                        )
+                        setting[0] = conf['Address']
                 except ValueError:
                     logger.error(
                     'Address record in %s.conf is not correct\n',
@@ -300,12 +579,7 @@ class WgSetup:
                     if conf_port < 0 or conf_port > 65536:
                         raise InvalidPort(conf_port)
                     if conf_port != port:
-                        db_write(
-                            self.conn,
-                            'UPDATE wgconsole_interface\n'
-                            f'SET port = \'{conf["ListenPort"]}\'\n'
-                            f'WHERE name = \'{name}\';'
-                            )
+                        setting[1] = conf_port
                 except InvalidPort:
                     logger.error(
                         'ListenPort record in %s.conf out of range\n',
@@ -322,26 +596,26 @@ class WgSetup:
                     name
                 )
             if 'PrivateKey' in conf:
-                private_key = conf['PrivateKey']
-                pubkey = run_cmmd(
-                    'wg pubkey',
-                    input_str = f'{private_key}',
-                    logerr = True
-                )
                 if pubkey is not False:
-                    pubkey = pubkey.rstrip('\n')
                     if pubkey != public_key:
-                        db_write(
-                            self.conn,
-                            'UPDATE wgconsole_interface\n'
-                            f'SET public_key = \'{pubkey}\'\n'
-                            f'WHERE name = \'{name}\';'
-                        )
+                        setting[2] = pubkey
             else:
                 logger.error(
                     'No PrivateKey record in %s.conf\n',
                     name
                 )
+            if setting != [None, None, None]:
+                settings.append((*setting, name))
+        # Single statement in name order, rows are locked in the same
+        # order as by WgControl running at the same time
+        written = db_write(
+            self.pool,
+            'EXECUTE wg_interface_setup (%s, %s, %s, %s);',
+            settings
+        )
+        # Remember checked settings only after they are committed
+        if written:
+            self._conf_hash.update(conf_hashes)
         logger.debug('End of executing WgSetup.conf_setup\n\n')
 
 class WgControl:
@@ -350,8 +624,9 @@ class WgControl:
     '''
 
     def __init__(self, state:WgState, conf:str) -> None:
-        self.wgstate = state.wgstate
-        self.conn = state.conn
+        # WgState replaces wgstate on update, read it through state
+        self.state = state
+        self.pool = state.pool
         self.conf = os.fspath(conf)
 
     def update(self) -> None:
@@ -359,62 +634,118 @@ class WgControl:
         Update Wireguard interfaces according state and status in db.
         '''
         logger.debug('Execute WgControl.update\n%s\n\n', '*'*80)
-        interface_records = db_read(
-            self.conn,
-            'SELECT name, status, state\n'
-            'FROM wgconsole_interface;'
+        records = db_read(
+            self.pool,
+            'EXECUTE wg_interface_peers;'
         )
-        for record in interface_records:
-            name, status, state = record
+        wgstates = self.state.wgstate
+        routes = []
+        interface_states, peer_states, peer_clears = [], [], []
+        for interface, group in itertools.groupby(
+            records, key=lambda record: record[:3]
+        ):
+            name, status, state = interface
+            wgstate = wgstates[name]
             if state is False and status is True:
-                run_cmmd(
-                    f'wg-quick up {self.conf}/{name}.conf',
+                if run_cmmd(
+                    ['wg-quick', 'up', f'{self.conf}/{name}.conf'],
                     logerr=True,
-                )
+                ) is not False:
+                    wgstate.update({'state': True, 'peers': {}})
+                    interface_states.append((True, name))
             if state is True and status is False:
-                run_cmmd(
-                    f'wg-quick down {self.conf}/{name}.conf',
+                if run_cmmd(
+                    ['wg-quick', 'down', f'{self.conf}/{name}.conf'],
                     logerr=True,
-                )
+                ) is not False:
+                    peer_clears.extend(
+                        (public_key,) for public_key in wgstate['peers']
+                    )
+                    wgstate.update({'state': False, 'peers': {}})
+                    interface_states.append((False, name))
             if status is False:
                 continue
-            peer_records = db_read(
-                self.conn,
-                'SELECT public_key, allowed_ips, status\n'
-                'FROM wgconsole_peer\n'
-                f'WHERE interface_id = \'{name}\';'
-            )
-            peers = list(self.wgstate[name]['peers'])
+            peers = list(wgstate['peers'])
             logger.debug(
                 'List of peers from wgstate:\n%s\n',
                 peers
             )
-            for record in peer_records:
-                public_key, allowed_ips, peer_status = record
+            changes = [] # (public_key, wg set arguments, route)
+            added = {}
+            for record in group:
+                public_key, allowed_ips, peer_status = record[3:]
+                if public_key is None:
+                    continue
                 if public_key not in peers and peer_status is True:
-                    run_cmmd(
-                        f'wg set {name} peer {public_key} '
-                        f'allowed-ips {allowed_ips}'
-                    )
-                    run_cmmd(
-                        f'ip -4 route add {allowed_ips} dev {name}'
-                    )
+                    changes.append((
+                        public_key,
+                        ['peer', public_key, 'allowed-ips', allowed_ips],
+                        f'route add {allowed_ips} dev {name}',
+                    ))
+                    added[public_key] = PeerState(allowed_ips = allowed_ips)
                 if public_key in peers and peer_status is False:
-                    run_cmmd(
-                        f'wg set {name} peer {public_key} remove'
-                    )
-                    run_cmmd(
-                        f'ip -4 route del {allowed_ips} dev {name}'
-                    )
+                    changes.append((
+                        public_key,
+                        ['peer', public_key, 'remove'],
+                        f'route del {allowed_ips} dev {name}',
+                    ))
                 if public_key in peers:
                     peers.remove(public_key)
             for public_key in peers:
-                run_cmmd(
-                    f'wg set {name} peer {public_key} remove'
-                )
-                allowed_ips = self.wgstate[name]['peers'][public_key]\
-                    ['allowed ips']
-                run_cmmd(
-                    f'ip -4 route del {allowed_ips} dev {name}'
-                )
+                allowed_ips = wgstate['peers'][public_key].allowed_ips
+                changes.append((
+                    public_key,
+                    ['peer', public_key, 'remove'],
+                    f'route del {allowed_ips} dev {name}',
+                ))
+            applied = []
+            if changes:
+                if run_cmmd(
+                    ['wg', 'set', name, *itertools.chain.from_iterable(
+                        change[1] for change in changes
+                    )],
+                    logerr=True,
+                ) is not False:
+                    applied = changes
+                elif len(changes) > 1:
+                    # One bad peer fails whole command, apply peers one
+                    # by one, single change has failed already
+                    for change in changes:
+                        if run_cmmd(
+                            ['wg', 'set', name, *change[1]],
+                            logerr=True,
+                        ) is not False:
+                            applied.append(change)
+            # Keep wgstate in line with applied changes instead of
+            # reading whole state again
+            for public_key, _, route in applied:
+                routes.append(route)
+                if public_key in added:
+                    wgstate['peers'][public_key] = added[public_key]
+                    peer_states.append((str(added[public_key]), public_key))
+                else:
+                    wgstate['peers'].pop(public_key, None)
+                    peer_clears.append((public_key,))
+        if routes:
+            run_cmmd(
+                ['ip', '-4', '-force', '-batch', '-'],
+                input_str = '\n'.join(routes) + '\n'
+            )
+        # Transaction is opened only after all commands have finished
+        with db_transaction(self.pool):
+            db_write(
+                self.pool,
+                'EXECUTE wg_interface_state (%s, %s);',
+                interface_states
+            )
+            db_write(
+                self.pool,
+                'EXECUTE wg_peer_state (%s, %s);',
+                peer_states
+            )
+            db_write(
+                self.pool,
+                'EXECUTE wg_peer_clear (%s);',
+                peer_clears
+            )
         logger.debug('End of executing WgControl.update\n\n')
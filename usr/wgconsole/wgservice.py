@@ -7,80 +7,197 @@ Systemd service for managing wireguard interfaces and database.
 import os
 import sys
 import time
+import random
+import queue
+import atexit
+import signal
+import selectors
+import concurrent.futures
+import importlib.util
 import logging
-import logging.config
+import logging.handlers
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 import wgconsole
 
+def backoff(delay:float) -> float:
+    '''
+    Sleep for delay with jitter, return next delay doubled up to 60
+    seconds.
+    '''
+    # Jitter spreads reconnects of many hosts after an outage
+    time.sleep(delay + random.uniform(0, delay*0.5))
+    return min(delay*2, 60)
+
+def db_connect(dbargs:dict, pool = None) -> tuple:
+    '''
+    Create connection pool if not given and notification listener
+    connection, retry with exponential backoff until database is
+    available.
+    '''
+    delay = 1
+    while True:
+        listener = None
+        try:
+            if pool is None:
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    # Cycle runs two transactions at once, keep both
+                    minconn = 2,
+                    maxconn = 4,
+                    **dbargs
+                )
+            listener = psycopg2.connect(**dbargs)
+            listener.autocommit = True
+            wgconsole.db_listen(listener)
+            return pool, listener
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            logger.error('Error connecting to database\n')
+            if listener is not None:
+                listener.close()
+            delay = backoff(delay)
+
+class CachedFormatter(logging.Formatter):
+    '''
+    Log formatter formatting time once per second.
+    '''
+    _cached = (None, '') # epoch second, formatted time
+
+    def formatTime(self, record, datefmt = None) -> str:
+        if datefmt is None:
+            # Default format contains milliseconds
+            return super().formatTime(record, datefmt)
+        second = int(record.created)
+        cached = self._cached
+        if cached[0] != second:
+            cached = (second, super().formatTime(record, datefmt))
+            self._cached = cached
+        return cached[1]
+
 if __name__ == '__main__':
 
-    sys.path.append(os.path.abspath('/etc/wgconsole'))
-    import config
+    # Load config without adding /etc/wgconsole to sys.path
+    spec = importlib.util.spec_from_file_location(
+        'config', '/etc/wgconsole/config.py'
+    )
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
 
     DBNAME = config.DBNAME
     DBUSER = config.DBUSER
     DBPASS = config.DBPASS
     DBHOST = config.DBHOST
     DBPORT = config.DBPORT
+    DBARGS = {
+        'dbname': DBNAME,
+        'user': DBUSER,
+        'password': DBPASS,
+        'host': DBHOST,
+        'port': DBPORT,
+        'connect_timeout': 10,
+        # Detect dead connections dropped by NAT or firewall
+        'keepalives': 1,
+        'keepalives_idle': 60,
+        'keepalives_interval': 10,
+        'keepalives_count': 5,
+        # Abort hung queries and transactions left open by the service
+        'options': (
+            '-c statement_timeout=8s '
+            '-c idle_in_transaction_session_timeout=15s'
+        ),
+    }
 
-    CONF = os.path.abspath('/etc/wgconsole/conf.d')
-    LOGF = os.path.abspath('/var/wgconsole/service.log')
+    CONF = '/etc/wgconsole/conf.d'
+    LOGF = '/var/wgconsole/service.log'
+    WAIT = 30 # max seconds between cycles without database notifications
 
-    if not os.path.exists(LOGF.rstrip('service.log')):
-        os.makedirs(LOGF.rstrip('service.log'))
+    os.makedirs(os.path.dirname(LOGF), exist_ok=True)
 
-    logging.config.dictConfig({
-        'version':1,
-        'formatters':{
-            'message':{
-                'format':'%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                'datefmt':'%Y.%m.%d %H:%M:%S',
-            },
-        },
-        'handlers':{
-            'console':{
-                'class':'logging.StreamHandler',
-                'formatter':'message',
-            },
-            'file':{
-                'class':'logging.handlers.RotatingFileHandler',
-                'formatter':'message',
-                'filename':f'{LOGF}',
-                'maxBytes': 1024*1024*1,
-                'backupCount': 3,
-            },
-        },
-        'root':{
-            'level':'ERROR',
-            'handlers':['file',],
-        },
-        'disable_existing_loggers':False,
-    })
+    # Log file is written from background thread, records are formatted
+    # by queue handler already
+    log_queue = queue.Queue(-1)
+    log_listener = logging.handlers.QueueListener(
+        log_queue,
+        logging.handlers.RotatingFileHandler(
+            LOGF,
+            maxBytes = 1024*1024*1,
+            backupCount = 3,
+        ),
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    # Exit through atexit on systemd stop to flush queued records
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    log_handler = logging.handlers.QueueHandler(log_queue)
+    log_handler.setFormatter(CachedFormatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        '%Y.%m.%d %H:%M:%S',
+    ))
+    logging.root.setLevel(logging.ERROR)
+    logging.root.addHandler(log_handler)
     logger = logging.getLogger('wgconsole')
 
     # Change process name
-    if os.uname()[0] == 'Linux':
+    if sys.platform.startswith('linux'):
         import ctypes
-        libc = ctypes.cdll.LoadLibrary('libc.so.6')
-        libc.prctl(15, b'wgconsole', None, None, None)
+        # libc is already loaded into the process, PR_SET_NAME = 15
+        ctypes.CDLL(None, use_errno=True).prctl(15, b'wgconsole', 0, 0, 0)
 
+    pool, listener = db_connect(DBARGS)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    # Pool survives reconnects, objects are created only once
+    state = wgconsole.WgState(pool)
+    setup = wgconsole.WgSetup(state, CONF)
+    control = wgconsole.WgControl(state, CONF)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = 2)
+    delay = 1 # backoff while pool fails but listener is alive
     while True:
         try:
-            connection = psycopg2.connect(
-                dbname = DBNAME,
-                user = DBUSER,
-                password = DBPASS,
-                host = DBHOST,
-                port = DBPORT
+            state.update()
+            # Settings and interfaces don't depend on each other, snapshot
+            # interfaces that are down before WgControl may bring them up
+            down = {
+                name for name, interface in state.wgstate.items()
+                if interface['state'] is False
+            }
+            futures = [
+                executor.submit(setup.conf_setup, down),
+                executor.submit(control.update),
+            ]
+            concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+            delay = 1
+            # Wait for changes in database, but no longer than WAIT
+            if selector.select(timeout = WAIT):
+                listener.poll()
+                listener.notifies.clear()
+        except (
+            psycopg2.extensions.QueryCanceledError,
+            psycopg2.extensions.TransactionRollbackError,
+        ) as exception:
+            # Statement timeout or deadlock, connections are still usable
+            logger.error(
+                'Database statement aborted, retrying'
+                '\n%s\n', exception
             )
-        except psycopg2.OperationalError:
-            logger.error('Error connecting to database\n')
-            time.sleep(5)
-            continue
-        state = wgconsole.WgState(connection)
-        state.update()
-        wgconsole.WgSetup(state, CONF).conf_setup()
-        wgconsole.WgControl(state, CONF).update()
-        state.update()
-        connection.close()
-        time.sleep(10)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            logger.error('Lost connection to database\n')
+            # Pool discards broken connections by itself, psycopg2 marks
+            # listener closed once it fails to use it
+            try:
+                with listener.cursor() as curl:
+                    curl.execute('SELECT 1;')
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                pass
+            if not listener.closed:
+                delay = backoff(delay)
+                continue
+            # Closed listener has no fileno to unregister, replace selector
+            selector.close()
+            listener.close()
+            pool, listener = db_connect(DBARGS, pool)
+            selector = selectors.DefaultSelector()
+            selector.register(listener, selectors.EVENT_READ)